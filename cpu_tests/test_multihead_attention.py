@@ -6,7 +6,7 @@
 import unittest
 
 import torch
-from metaseq.modules.multihead_attention import MultiheadAttention
+from metaseq.modules.multihead_attention import MultiheadAttention, has_sdpa
 
 
 class TestMultiheadAttention(unittest.TestCase):
@@ -51,11 +51,179 @@ class TestMultiheadAttention(unittest.TestCase):
                     f"Unexpected resultant key padding mask: {key_padding_mask}"
                     f" given current: {c[0]} and previous: {c[1]}",
                 )
+                self.assertEqual(key_padding_mask.dtype, torch.bool)
                 self.assertEqual(key_padding_mask.size(0), bsz)
                 self.assertEqual(key_padding_mask.size(1), src_len)
             else:
                 self.assertIsNone(c[2])
 
+    def test_upgrade_split_qkv_state_dict(self):
+        torch.manual_seed(0)
+        split = MultiheadAttention(8, 2, self_attention=True).eval()
+        packed = MultiheadAttention(
+            8, 2, self_attention=True, combine_qkv_proj=True
+        ).eval()
+
+        state_dict = split.state_dict()
+        packed.upgrade_state_dict_named(state_dict, "")
+        packed.load_state_dict(state_dict)
+
+        x = torch.rand(5, 2, 8)
+        self.assertTrue(
+            torch.allclose(split(x, x, x)[0], packed(x, x, x)[0], atol=1e-6)
+        )
+
+        state_dict = packed.state_dict()
+        split.upgrade_state_dict_named(state_dict, "")
+        split.load_state_dict(state_dict)
+
+    @unittest.skipIf(not has_sdpa, "requires F.scaled_dot_product_attention")
+    def test_sdpa_matches_eager_attention(self):
+        torch.manual_seed(0)
+        tgt_len, bsz, embed_dim = 5, 2, 8
+        mha = MultiheadAttention(embed_dim, num_heads=2, self_attention=True).eval()
+        x = torch.rand(tgt_len, bsz, embed_dim)
+        attn_mask = torch.triu(torch.full((tgt_len, tgt_len), float("-inf")), 1)
+        key_padding_mask = torch.zeros(bsz, tgt_len, dtype=torch.bool)
+        key_padding_mask[1, -1] = True
+
+        outputs = []
+        # need_weights=True keeps the eager path, need_weights=False uses SDPA
+        for need_weights in (True, False):
+            out, _ = mha(
+                x,
+                x,
+                x,
+                key_padding_mask=key_padding_mask,
+                incremental_state={},
+                need_weights=need_weights,
+                attn_mask=attn_mask,
+            )
+            outputs.append(out)
+        self.assertTrue(torch.allclose(outputs[0], outputs[1], atol=1e-6))
+
+    def test_kv_cache_dtype(self):
+        torch.manual_seed(0)
+        mha = MultiheadAttention(64, num_heads=4, self_attention=True).eval()
+        x = torch.randn(16, 2, 64)
+
+        def decode(kv_cache_dtype, need_weights):
+            mha.make_generation_fast_(kv_cache_dtype=kv_cache_dtype)
+            incremental_state = {}
+            outputs = []
+            for i in range(x.size(0)):
+                step = x[i : i + 1]
+                out, _ = mha(
+                    step,
+                    step,
+                    step,
+                    incremental_state=incremental_state,
+                    need_weights=need_weights,
+                )
+                outputs.append(out)
+            return torch.cat(outputs), mha._get_input_buffer(incremental_state)
+
+        # need_weights=True takes the eager path, need_weights=False uses SDPA
+        for need_weights in (True, False):
+            expected, _ = decode(None, need_weights)
+            out, saved_state = decode(torch.bfloat16, need_weights)
+            self.assertEqual(out.dtype, torch.float32)
+            self.assertEqual(saved_state["prev_key"].dtype, torch.bfloat16)
+            self.assertEqual(saved_state["prev_value"].dtype, torch.bfloat16)
+            # only q, k and v are rounded to bf16 (8 significant bits), so the
+            # error stays within 2 bf16 ulps of the output scale
+            atol = 2**-7 * expected.abs().max().item()
+            self.assertLessEqual((expected - out).abs().max().item(), atol)
+
+    def test_reduced_precision_softmax(self):
+        torch.manual_seed(0)
+        bsz, seq_len, num_heads = 2, 16, 4
+        mha = MultiheadAttention(64, num_heads, self_attention=True).eval()
+        q, k = torch.randn(2, bsz * num_heads, seq_len, 16, dtype=torch.bfloat16)
+        scores = torch.baddbmm(q.new_empty(()), q, k.mT, beta=0.0, alpha=mha.scaling)
+        attn_mask = torch.triu(torch.full((seq_len, seq_len), float("-inf")), 1)
+        key_padding_mask = torch.zeros(bsz, seq_len, dtype=torch.bool)
+        key_padding_mask[1, -3:] = True
+
+        # the masks are applied in place, hence the clones
+        weights, probs_fp32 = mha._masked_softmax_dropout(
+            scores.clone(), attn_mask, key_padding_mask, need_weights=True
+        )
+        none, probs = mha._masked_softmax_dropout(
+            scores.clone(), attn_mask, key_padding_mask, need_weights=False
+        )
+        self.assertIsNone(none)
+        self.assertEqual(weights.dtype, torch.float32)
+        self.assertEqual(probs.dtype, torch.bfloat16)
+        # probabilities are in [0, 1], one bf16 ulp of 1.0 is 2**-8
+        for out in (probs, probs_fp32):
+            self.assertLessEqual((out.float() - weights).abs().max().item(), 2**-8)
+
+    def test_preallocated_kv_cache(self):
+        torch.manual_seed(0)
+        mha = MultiheadAttention(8, num_heads=2, self_attention=True).eval()
+        x = torch.rand(6, 2, 8)
+        new_order = torch.tensor([1, 0])
+
+        def decode():
+            incremental_state = {}
+            outputs = []
+            for i in range(x.size(0)):
+                step = x[i : i + 1]
+                out, _ = mha(step, step, step, incremental_state=incremental_state)
+                outputs.append(out)
+                if i == 2:
+                    mha.reorder_incremental_state(incremental_state, new_order)
+            return torch.cat(outputs), mha._get_input_buffer(incremental_state)
+
+        # autograd disables the buffers and falls back to concatenation
+        expected, _ = decode()
+        with torch.no_grad():
+            out, saved_state = decode()
+        self.assertTrue(torch.allclose(expected, out, atol=1e-6))
+        self.assertEqual(saved_state["prev_key"].size(2), x.size(0))
+        self.assertEqual(
+            saved_state["prev_key"].data_ptr(),
+            saved_state["prev_key_buffer"].data_ptr(),
+        )
+
+        # room for twice the prompt length, capped at max_seq_len
+        mha.make_generation_fast_(max_seq_len=x.size(0))
+        for prompt_len, capacity in ((2, 4), (4, x.size(0))):
+            saved_state = {}
+            k = torch.rand(4, prompt_len, 4)
+            mha._append_to_kv_buffer(saved_state, "prev_key", k, 2)
+            self.assertEqual(saved_state["prev_key_buffer"].size(2), capacity)
+
+    def test_tensor_parallel_attention(self):
+        torch.manual_seed(0)
+        world_size, bsz, seq_len, num_heads = 2, 2, 3, 4
+        mha = MultiheadAttention(8, num_heads, self_attention=True).eval()
+        head_dim = mha.head_dim
+        # this rank's heads over the inputs gathered from all ranks
+        local_heads = num_heads // world_size
+        q, k, v = torch.rand(3, bsz * local_heads, world_size * seq_len, head_dim)
+        attn_mask = torch.triu(torch.full((seq_len, seq_len), float("-inf")), 1)
+        key_padding_mask = torch.zeros(bsz, seq_len, dtype=torch.bool)
+        key_padding_mask[1, -1] = True
+
+        out = mha._tensor_parallel_attention(
+            q, k, v, attn_mask, key_padding_mask, bsz, world_size
+        )
+
+        # each rank's block of the sequence only attends within itself
+        expected = torch.empty_like(q)
+        for i in range(bsz * local_heads):
+            mask = attn_mask.masked_fill(
+                key_padding_mask[i // local_heads], float("-inf")
+            )
+            for w in range(world_size):
+                block = slice(w * seq_len, (w + 1) * seq_len)
+                scores = q[i, block] @ k[i, block].T * mha.scaling + mask
+                expected[i, block] = scores.softmax(dim=-1) @ v[i, block]
+        self.assertEqual(out.shape, q.shape)
+        self.assertTrue(torch.allclose(expected, out, atol=1e-6))
+
 
 if __name__ == "__main__":
     unittest.main()
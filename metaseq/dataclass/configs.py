@@ -16,6 +16,7 @@ from metaseq.dataclass.constants import (
     LOG_FORMAT_CHOICES,
     ZERO_SHARDING_CHOICES,
     CLIP_GRAD_NORM_TYPE_CHOICES,
+    KV_CACHE_DTYPE_CHOICES,
 )
 
 
@@ -651,6 +652,13 @@ class GenerationConfig(MetaseqDataclass):
         default=False,
         metadata={"help": "if set, dont use seed for initializing random generators"},
     )
+    kv_cache_dtype: Optional[KV_CACHE_DTYPE_CHOICES] = field(
+        default=None,
+        metadata={
+            "help": "store the incremental decoding key/value cache in this dtype "
+            "(e.g. bf16 for an fp32 model); defaults to the model dtype"
+        },
+    )
     # former interactive args
     buffer_size: int = field(
         default=0,
@@ -45,3 +45,4 @@ DDP_BACKEND_CHOICES = ChoiceEnum(
 DATASET_IMPL_CHOICES = ChoiceEnum(["raw", "lazy", "cached", "mmap", "fasta"])
 ZERO_SHARDING_CHOICES = ChoiceEnum(["none", "os"])
 CLIP_GRAD_NORM_TYPE_CHOICES = ChoiceEnum(["l2", "inf"])
+KV_CACHE_DTYPE_CHOICES = ChoiceEnum(["fp16", "bf16"])
@@ -472,7 +472,7 @@ class GeneratorInterface:
 
         def _build_model(cfg, task):
             model = task.build_model(cfg.model).half().cuda()
-            model.make_generation_fast_()
+            model.prepare_for_inference_(self.cfg)
             return fsdp_wrap(model)
 
         # Load the model
@@ -512,25 +512,32 @@ class ModelParallelMultiheadAttention(nn.Module):
             new_key_padding_mask = prev_key_padding_mask
         elif prev_key_padding_mask is not None and key_padding_mask is not None:
             new_key_padding_mask = torch.cat(
-                [prev_key_padding_mask.float(), key_padding_mask.float()], dim=1
+                [prev_key_padding_mask.to(torch.bool), key_padding_mask.to(torch.bool)],
+                dim=1,
             )
         # During incremental decoding, as the padding token enters and
         # leaves the frame, there will be a time when prev or current
         # is None
         elif prev_key_padding_mask is not None:
 
-            filler = torch.zeros(batch_size, src_len - prev_key_padding_mask.size(1))
-            if prev_key_padding_mask.is_cuda:
-                filler = filler.cuda()
+            filler = torch.zeros(
+                batch_size,
+                src_len - prev_key_padding_mask.size(1),
+                dtype=torch.bool,
+                device=prev_key_padding_mask.device,
+            )
             new_key_padding_mask = torch.cat(
-                [prev_key_padding_mask.float(), filler.float()], dim=1
+                [prev_key_padding_mask.to(torch.bool), filler], dim=1
             )
         elif key_padding_mask is not None:
-            filler = torch.zeros(batch_size, src_len - key_padding_mask.size(1))
-            if key_padding_mask.is_cuda:
-                filler = filler.cuda()
+            filler = torch.zeros(
+                batch_size,
+                src_len - key_padding_mask.size(1),
+                dtype=torch.bool,
+                device=key_padding_mask.device,
+            )
             new_key_padding_mask = torch.cat(
-                [filler.float(), key_padding_mask.float()], dim=1
+                [filler, key_padding_mask.to(torch.bool)], dim=1
             )
         else:
             new_key_padding_mask = prev_key_padding_mask
@@ -153,6 +153,13 @@ class BaseModel(nn.Module):
             else getattr(cfg.generation, "beam", 5)
         )
         kwargs["need_attn"] = False
+        kv_cache_dtype = getattr(cfg.generation, "kv_cache_dtype", None)
+        if kv_cache_dtype is not None:
+            kwargs["kv_cache_dtype"] = {"fp16": torch.float16, "bf16": torch.bfloat16}[
+                str(kv_cache_dtype)
+            ]
+        if hasattr(self, "max_decoder_positions"):
+            kwargs["max_seq_len"] = self.max_decoder_positions()
         self.make_generation_fast_(**kwargs)
 
     def make_generation_fast_(self, **kwargs):
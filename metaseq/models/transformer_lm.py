@@ -159,6 +159,20 @@ class TransformerLanguageModelConfig(MetaseqDataclass):
     no_emb_dropout: Optional[bool] = field(
         default=False, metadata={"help": "Avoid emb dropout for decoder"}
     )
+    combine_qkv_proj: bool = field(
+        default=False,
+        metadata={
+            "help": "pack the self-attention q/k/v projections into a single "
+            "linear layer; changes the parameter names, ignored with tensor parallel"
+        },
+    )
+    compile_attention: bool = field(
+        default=False,
+        metadata={
+            "help": "run the eager attention softmax/dropout chain through "
+            "torch.compile on CUDA (requires Inductor/Triton)"
+        },
+    )
 
     # options from other parts of the config
     add_bos_token: bool = II("task.add_bos_token")
@@ -168,6 +182,7 @@ class TransformerLanguageModelConfig(MetaseqDataclass):
     fp16: bool = II("common.fp16")
     fp16_no_flatten_grads: bool = II("common.fp16_no_flatten_grads")
     ddp_backend: str = II("distributed_training.ddp_backend")
+    tp_enabled: bool = II("distributed_training.tp_enabled")
     world_size: int = II("distributed_training.distributed_world_size")
     distributed_rank: int = II("distributed_training.distributed_rank")
     batch_size: Optional[int] = II("dataset.batch_size")
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import math
 import sys
 from typing import Dict, Optional, Tuple
@@ -18,6 +19,102 @@ from torch.nn import Parameter
 from torch.distributed._shard.sharded_tensor import ShardedTensor
 import metaseq.distributed.utils as distributed_utils
 
+# Fused attention (FlashAttention / memory-efficient kernels) is only available
+# from PyTorch 2.0 onwards.
+has_sdpa = hasattr(F, "scaled_dot_product_attention")
+has_torch_compile = hasattr(torch, "compile")
+
+
+def _masked_softmax_dropout(
+    attn_weights: Tensor,
+    attn_mask: Optional[Tensor],
+    key_padding_mask: Optional[Tensor],
+    num_heads: int,
+    p: float,
+    training: bool,
+    need_weights: bool,
+) -> Tuple[Optional[Tensor], Tensor]:
+    """Mask-add, padding mask, softmax and dropout over the (already scaled)
+    attention scores.
+
+    With *need_weights*, the scores are upcast first and the fp32 attention
+    weights are returned alongside the probabilities. Otherwise the softmax
+    runs in the dtype of *attn_weights* (which still accumulates in fp32) and
+    no fp32 copy of the scores is materialized; None is returned in place of
+    the weights. The attention probabilities after dropout are always in the
+    dtype of *attn_weights*.
+    """
+    bsz_heads, tgt_len, src_len = attn_weights.size()
+    scores = attn_weights.float() if need_weights else attn_weights
+    if attn_mask is not None:
+        scores = scores + attn_mask.unsqueeze(0).to(scores.dtype)
+    if key_padding_mask is not None:
+        # don't attend to padding symbols. scores is a fresh tensor (the score
+        # GEMM or mask-add output) that autograd does not need, so it is
+        # filled in place through a per-head view.
+        scores.view(-1, num_heads, tgt_len, src_len).masked_fill_(
+            key_padding_mask.view(-1, 1, 1, src_len).to(torch.bool),
+            float("-inf"),
+        )
+    scores = F.softmax(scores, dim=-1)
+    attn_weights_float: Optional[Tensor] = None
+    if need_weights:
+        attn_weights_float = scores
+    attn_probs = F.dropout(scores.to(attn_weights.dtype), p=p, training=training)
+    return attn_weights_float, attn_probs
+
+
+@functools.lru_cache(maxsize=None)
+def _fused_masked_softmax_dropout():
+    # Scripting lets the JIT fuser merge the elementwise ops of the chain
+    # above (mask add, casts) into fewer passes over the
+    # `(bsz * num_heads, tgt_len, src_len)` tensor; softmax and dropout still
+    # run as their own kernels. Scripted lazily to keep import cheap.
+    return torch.jit.script(_masked_softmax_dropout)
+
+
+@functools.lru_cache(maxsize=None)
+def _jit_fusion_supported(device: torch.device) -> bool:
+    # The JIT fusers are known to misbehave on ROCm and on GPUs older than
+    # Volta, the unfused implementation is used there.
+    if device.type != "cuda":
+        return True
+    if torch.version.hip is not None:
+        return False
+    return torch.cuda.get_device_capability(device)[0] >= 7
+
+
+def _attention_core(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    attn_mask: Tensor,
+    key_padding_mask: Tensor,
+    num_heads: int,
+    scaling: float,
+    p: float,
+    training: bool,
+    need_weights: bool,
+) -> Tuple[Tensor, Optional[Tensor]]:
+    """Scores, softmax, dropout and the attention-weighted sum of *v*.
+
+    The masks are always tensors (all zeros / all False when unused), so that
+    their presence does not become a guard of the compiled graph. Returns the
+    attention output and, if *need_weights*, the fp32 attention weights.
+    """
+    attn_weights = torch.baddbmm(q.new_empty(()), q, k.mT, beta=0.0, alpha=scaling)
+    attn_weights_float, attn_probs = _masked_softmax_dropout(
+        attn_weights, attn_mask, key_padding_mask, num_heads, p, training, need_weights
+    )
+    return torch.bmm(attn_probs, v), attn_weights_float
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_attention_core():
+    # Inductor fuses the mask/softmax/dropout chain around the two cuBLAS
+    # GEMMs. dynamic=True avoids recompiling for every new sequence length.
+    return torch.compile(_attention_core, dynamic=True)
+
 
 @with_incremental_state
 class MultiheadAttention(nn.Module):
@@ -39,6 +136,8 @@ class MultiheadAttention(nn.Module):
         self_attention=False,
         encoder_decoder_attention=False,
         initialize_params_on_gpu=False,
+        combine_qkv_proj=False,
+        compile_attention_core=False,
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -61,33 +160,47 @@ class MultiheadAttention(nn.Module):
         assert not self.self_attention or self.qkv_same_dim, (
             "Self-attention requires query, key and " "value to be of the same size"
         )
-        random_state = torch.get_rng_state()
-        # random_state_cuda = torch.cuda.get_rng_state()
-        self.k_proj = Linear(
-            self.kdim,
-            embed_dim,
-            bias=bias,
-            initialize_params_on_gpu=initialize_params_on_gpu,
-        )
-        self.v_proj = Linear(
-            self.vdim,
-            embed_dim,
-            bias=bias,
-            initialize_params_on_gpu=initialize_params_on_gpu,
-        )
-        self.q_proj = Linear(
-            embed_dim,
-            embed_dim,
-            bias=bias,
-            initialize_params_on_gpu=initialize_params_on_gpu,
+        # For self-attention, q, k and v are projected from the same input, so
+        # with combine_qkv_proj they can be packed (in q, k, v order) into a
+        # single GEMM of 3x output width. This changes the parameter layout,
+        # which FSDP and tensor parallel shard by name, so it is opt-in.
+        self.combine_qkv_proj = (
+            combine_qkv_proj and self.self_attention and self.qkv_same_dim
         )
+        if self.combine_qkv_proj:
+            self.in_proj = Linear(
+                embed_dim,
+                3 * embed_dim,
+                bias=bias,
+                initialize_params_on_gpu=initialize_params_on_gpu,
+            )
+            self.k_proj = self.v_proj = self.q_proj = None
+        else:
+            self.in_proj = None
+            self.k_proj = Linear(
+                self.kdim,
+                embed_dim,
+                bias=bias,
+                initialize_params_on_gpu=initialize_params_on_gpu,
+            )
+            self.v_proj = Linear(
+                self.vdim,
+                embed_dim,
+                bias=bias,
+                initialize_params_on_gpu=initialize_params_on_gpu,
+            )
+            self.q_proj = Linear(
+                embed_dim,
+                embed_dim,
+                bias=bias,
+                initialize_params_on_gpu=initialize_params_on_gpu,
+            )
         self.out_proj = Linear(
             embed_dim,
             embed_dim,
             bias=bias,
             initialize_params_on_gpu=initialize_params_on_gpu,
         )
-        torch.set_rng_state(random_state)
         if add_bias_kv:
             self.bias_k = Parameter(torch.Tensor(1, 1, embed_dim))
             self.bias_v = Parameter(torch.Tensor(1, 1, embed_dim))
@@ -95,10 +208,19 @@ class MultiheadAttention(nn.Module):
             self.bias_k = self.bias_v = None
 
         self.add_zero_attn = add_zero_attn
+        # Run the eager attention core through torch.compile on CUDA, see
+        # _compiled_attention_core. Requires a working Inductor/Triton setup.
+        self.compile_attention_core = compile_attention_core
 
         self.reset_parameters()
 
         self.onnx_trace = False
+        # dtype of the incremental decoding key/value cache, see
+        # make_generation_fast_. None keeps the activation dtype.
+        self.kv_cache_dtype: Optional[torch.dtype] = None
+        # Upper bound on the preallocated key/value cache capacity, see
+        # _append_to_kv_buffer.
+        self.max_seq_len: Optional[int] = None
 
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
@@ -109,7 +231,19 @@ class MultiheadAttention(nn.Module):
             bound = 1 / math.sqrt(fan_in)
             nn.init.uniform_(bias, -bound, bound)
 
-        if self.qkv_same_dim:
+        if self.in_proj is not None:
+            # Same scaled initialization as below, applied to each of the
+            # packed q, k and v projections (in the same order).
+            q_weight, k_weight, v_weight = self.in_proj.weight.chunk(3, dim=0)
+            nn.init.xavier_uniform_(k_weight, gain=1 / math.sqrt(2))
+            nn.init.xavier_uniform_(v_weight, gain=1 / math.sqrt(2))
+            nn.init.xavier_uniform_(q_weight, gain=1 / math.sqrt(2))
+            if self.in_proj.bias is not None:
+                q_bias, k_bias, v_bias = self.in_proj.bias.chunk(3, dim=0)
+                _init_method_bias(k_weight, k_bias)
+                _init_method_bias(v_weight, v_bias)
+                _init_method_bias(q_weight, q_bias)
+        elif self.qkv_same_dim:
             # Empirically observed the convergence to be much better with
             # the scaled initialization
             nn.init.xavier_uniform_(self.k_proj.weight, gain=1 / math.sqrt(2))
@@ -167,7 +301,6 @@ class MultiheadAttention(nn.Module):
         tgt_len, bsz, embed_dim = query.size()
         src_len = tgt_len
         assert embed_dim == self.embed_dim, f"query dim {embed_dim} != {self.embed_dim}"
-        assert list(query.size()) == [tgt_len, bsz, embed_dim]
         if key is not None:
             src_len, key_bsz, _ = key.size()
             if not torch.jit.is_scripting():
@@ -183,9 +316,29 @@ class MultiheadAttention(nn.Module):
             # treats bias in linear module as method.
             and not torch.jit.is_scripting()
             # When using tensor parallel or Megatron, this simple case will be skipped.
-            and not isinstance(self.q_proj.weight, ShardedTensor)
+            and not isinstance(self.out_proj.weight, ShardedTensor)
         ):
             assert key is not None and value is not None
+            if self.in_proj is not None:
+                return F.multi_head_attention_forward(
+                    query,
+                    key,
+                    value,
+                    self.embed_dim,
+                    self.num_heads,
+                    self.in_proj.weight,
+                    self.in_proj.bias,
+                    self.bias_k,
+                    self.bias_v,
+                    self.add_zero_attn,
+                    self.dropout_module.p,
+                    self.out_proj.weight,
+                    self.out_proj.bias,
+                    self.training or self.dropout_module.apply_during_inference,
+                    key_padding_mask,
+                    need_weights,
+                    attn_mask,
+                )
             return F.multi_head_attention_forward(
                 query,
                 key,
@@ -193,7 +346,7 @@ class MultiheadAttention(nn.Module):
                 self.embed_dim,
                 self.num_heads,
                 torch.empty([0]),
-                torch.cat((self.q_proj.bias, self.k_proj.bias, self.v_proj.bias)),
+                self._cat_in_proj_bias(),
                 self.bias_k,
                 self.bias_v,
                 self.add_zero_attn,
@@ -210,6 +363,16 @@ class MultiheadAttention(nn.Module):
                 v_proj_weight=self.v_proj.weight,
             )
 
+        # SDPA never materializes the attention matrix, so it can only be used
+        # when the caller does not ask for the attention weights.
+        use_sdpa = (
+            not need_weights
+            and not before_softmax
+            and not self.onnx_trace
+            and not torch.jit.is_scripting()
+            and self._use_sdpa()
+        )
+
         if incremental_state is not None:
             saved_state = self._get_input_buffer(incremental_state)
             if saved_state is not None and "prev_key" in saved_state:
@@ -222,9 +385,13 @@ class MultiheadAttention(nn.Module):
             saved_state = None
 
         if self.self_attention:
-            q = self.q_proj(query)
-            k = self.k_proj(query)
-            v = self.v_proj(query)
+            if self.in_proj is not None:
+                # Already in (bsz * num_heads, seq_len, head_dim) layout.
+                q, k, v = self._in_proj_packed(query)
+            else:
+                q = self.q_proj(query)
+                k = self.k_proj(query)
+                v = self.v_proj(query)
         elif self.encoder_decoder_attention:
             # encoder-decoder attention
             q = self.q_proj(query)
@@ -240,12 +407,55 @@ class MultiheadAttention(nn.Module):
             q = self.q_proj(query)
             k = self.k_proj(key)
             v = self.v_proj(value)
-        q = q * self.scaling
+
+        # TP is implemented in a SPMD style, which means that we first gather all local
+        # input from across ranks and the output size will be world_size times bigger.
+        # For example, if input is [5, 10], proj weight size [10, 16] and world_size 4.
+        # Then the output of proj will be [4 * 5, 16] sharded by dim -1 (aka, 1).
+        # That's why we need to times the value by world_size to ensure assert is checking
+        # on the correct value.
+        # Since embed_dim = num_heads * head_dim and num_heads is divisible by
+        # world_size, each rank holds whole heads and attention is independent
+        # per head. The rest of the attention therefore runs directly on the
+        # local tensors, of shape (world_size * seq_len, bsz, embed_dim // world_size),
+        # and the result is wrapped into a ShardedTensor once before out_proj.
+        bsz_heads_dim = bsz * self.num_heads
+        world_size = 1
+        if isinstance(self.out_proj.weight, ShardedTensor):
+            # checked before saved_state is modified below
+            assert (
+                saved_state is None
+            ), "incremental decoding is not supported with tensor parallel attention"
+            assert (
+                not need_weights
+            ), "need_weights is not supported with tensor parallel attention"
+            world_size = len(self.out_proj.weight.sharding_spec().placements)
+            tgt_len *= world_size
+            src_len *= world_size
+            bsz_heads_dim //= world_size
+            # key_padding_mask is applied to each rank's block separately (see
+            # _tensor_parallel_attention), so it keeps its local src_len.
+            tp_sharding_spec = q.sharding_spec()
+            q = q.local_tensor()
+            if k is not None:
+                k = k.local_tensor()
+            if v is not None:
+                v = v.local_tensor()
+        if self.in_proj is None:
+            # The linear outputs are contiguous, so splitting the heads is a
+            # view and the transpose stays lazy; bmm/baddbmm and SDPA accept
+            # the transposed strides as they are.
+            q = q.view(tgt_len, bsz_heads_dim, self.head_dim).transpose(0, 1)
+            if k is not None:
+                k = k.view(-1, bsz_heads_dim, self.head_dim).transpose(0, 1)
+            if v is not None:
+                v = v.view(-1, bsz_heads_dim, self.head_dim).transpose(0, 1)
 
         if self.bias_k is not None:
             assert self.bias_v is not None
-            k = torch.cat([k, self.bias_k.repeat(1, bsz, 1)])
-            v = torch.cat([v, self.bias_v.repeat(1, bsz, 1)])
+            assert k is not None and v is not None
+            k = torch.cat([k, self._bias_kv_to_heads(self.bias_k, bsz)], dim=1)
+            v = torch.cat([v, self._bias_kv_to_heads(self.bias_v, bsz)], dim=1)
             if attn_mask is not None:
                 attn_mask = torch.cat(
                     [attn_mask, attn_mask.new_zeros(attn_mask.size(0), 1)], dim=1
@@ -258,62 +468,40 @@ class MultiheadAttention(nn.Module):
                     ],
                     dim=1,
                 )
-        
-        # TP is implemented in a SPMD style, which means that we first gather all local
-        # input from across ranks and the output size will be world_size times bigger.
-        # For example, if input is [5, 10], proj weight size [10, 16] and world_size 4.
-        # Then the output of proj will be [4 * 5, 16] sharded by dim -1 (aka, 1).
-        # That's why we need to times the value by world_size to ensure assert is checking
-        # on the correct value.
-        head_dim = self.head_dim
-        bsz_heads_dim = bsz * self.num_heads
-        if isinstance(self.q_proj.weight, ShardedTensor):
-            sharding_spec = self.q_proj.weight.sharding_spec()
-            world_size = len(sharding_spec.placements)
-            tgt_len *= world_size
-            src_len *= world_size
-            head_dim *= world_size
-            bsz_heads_dim //= world_size
-            # Now key_padding_mask needs to be duplicated world_size time.
-            if key_padding_mask is not None:
-                key_padding_mask = key_padding_mask.repeat(1, world_size)
-        q = q.contiguous().view(tgt_len, bsz_heads_dim, head_dim).transpose(0, 1)
-        if k is not None:
-            k = k.contiguous().view(-1, bsz_heads_dim, head_dim).transpose(0, 1)
-        if v is not None:
-            v = v.contiguous().view(-1, bsz_heads_dim, head_dim).transpose(0, 1)
-        # Megatron is switching sharding dim implicitly, so we have do this manually
-        # for ShardedTensor. Let's use an example to explain more here:
-        # Let's say tgt_len, bsz, embed_dim = q.size()
-        # Since we shard the result by -1 so that the local tensor size is:
-        # tgt_len, bsz, embed_dim // world_size
-        # Note that embed_dim = num_heads * head_dim and num_heads has to be
-        # divisible to world_size.
-        # So when we change the view from [tgt_len, bsz, embed_dim] to
-        # [tgt_len, bsz * num_heads, head_dim], we actually implicitely change
-        # the sharding dim from -1(2) to 1. That's also the reason why this parallel 
-        # makes sense here because each head is independent from each other.
-        # Currently, view op of sharded tensor does not support sharding dim change automatically,
-        # we need to manually re-create the ShardedTensor after sharding dim change.
-        if isinstance(q, ShardedTensor):
-            sharding_spec = q.sharding_spec()
-            sharding_spec.dim = 0
-            st_size = (bsz * self.num_heads, q.size(1), self.head_dim)
-            q = ShardedTensor._init_from_local_tensor(
-                q.local_tensor(), sharding_spec, st_size, process_group=distributed_utils.get_model_parallel_group()
-            )
+
+        kv_cache_dtype = self.kv_cache_dtype
+        if (
+            saved_state is not None
+            and kv_cache_dtype is not None
+            and not isinstance(self.out_proj.weight, ShardedTensor)
+        ):
+            # The two GEMMs against the cache run in the cache dtype: bmm needs
+            # matching dtypes and the memory-bound reads of the cache dominate.
+            # q is a single step, so casting it is cheap. The scores are cast
+            # back so that the masking and softmax run in the activation dtype.
+            q = q.to(kv_cache_dtype)
             if k is not None:
-                st_size = (bsz * self.num_heads, k.size(1), self.head_dim)
-                k = ShardedTensor._init_from_local_tensor(
-                    k.local_tensor(), sharding_spec, st_size, process_group=distributed_utils.get_model_parallel_group()
-                )
+                k = k.to(kv_cache_dtype)
             if v is not None:
-                st_size = (bsz * self.num_heads, v.size(1), self.head_dim)
-                v = ShardedTensor._init_from_local_tensor(
-                    v.local_tensor(), sharding_spec, st_size, process_group=distributed_utils.get_model_parallel_group()
-                )
+                v = v.to(kv_cache_dtype)
+        else:
+            kv_cache_dtype = None
 
-        if saved_state is not None:
+        # Outside of autograd, keys/values are appended to preallocated buffers
+        # instead of re-concatenating the whole cache every step.
+        use_kv_buffer = (
+            saved_state is not None
+            and not static_kv
+            and not torch.is_grad_enabled()
+            and not self.onnx_trace
+            and not isinstance(self.out_proj.weight, ShardedTensor)
+        )
+        if saved_state is not None and use_kv_buffer:
+            assert k is not None and v is not None
+            k = self._append_to_kv_buffer(saved_state, "prev_key", k, bsz)
+            v = self._append_to_kv_buffer(saved_state, "prev_value", v, bsz)
+            src_len = k.size(1)
+        elif saved_state is not None:
             # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
             if "prev_key" in saved_state:
                 _prev_key = saved_state["prev_key"]
@@ -334,6 +522,7 @@ class MultiheadAttention(nn.Module):
                 else:
                     assert v is not None
                     v = torch.cat([prev_value, v], dim=1)
+        if saved_state is not None:
             prev_key_padding_mask: Optional[Tensor] = None
             if "prev_key_padding_mask" in saved_state:
                 prev_key_padding_mask = saved_state["prev_key_padding_mask"]
@@ -353,7 +542,6 @@ class MultiheadAttention(nn.Module):
             assert incremental_state is not None
             incremental_state = self._set_input_buffer(incremental_state, saved_state)
         assert k is not None
-        assert k.size(1) == src_len
 
         # This is part of a workaround to get around fork/join parallelism
         # not supporting Optional types.
@@ -362,7 +550,7 @@ class MultiheadAttention(nn.Module):
 
         if key_padding_mask is not None:
             assert key_padding_mask.size(0) == bsz
-            assert key_padding_mask.size(1) == src_len
+            assert key_padding_mask.size(1) == src_len // world_size
 
         if self.add_zero_attn:
             assert v is not None
@@ -377,104 +565,121 @@ class MultiheadAttention(nn.Module):
                 key_padding_mask = torch.cat(
                     [
                         key_padding_mask,
-                        torch.zeros(key_padding_mask.size(0), 1).type_as(
-                            key_padding_mask
-                        ),
+                        key_padding_mask.new_zeros(key_padding_mask.size(0), 1),
                     ],
                     dim=1,
                 )
 
-        attn_weights = torch.bmm(q, k.transpose(1, 2))
-        # Since we are now performing a SPMD style calculation, the cross interaction 
-        # between weights from different ranks does not have actual meanings here. 
-        # We need to set them to zero or -inf(softmax). Think it of this way, the weights
-        # are interaction results between two related sequences or itself. The interaction
-        # between two random sequences here does not bring value to model training.
-        #TODO: Need to fix OOM for the big matrix.
-        if isinstance(attn_weights, ShardedTensor):
-            zero_mask = torch.ones(
-                *attn_weights.size(), device=attn_weights.local_tensor().device
+        attn_weights_float: Optional[Tensor] = None
+        if use_sdpa:
+            assert v is not None
+            attn = self._sdpa_attention(q, k, v, attn_mask, key_padding_mask, bsz)
+        elif isinstance(self.out_proj.weight, ShardedTensor):
+            assert (
+                not before_softmax
+            ), "before_softmax is not supported with tensor parallel attention"
+            assert k is not None and v is not None
+            attn = self._tensor_parallel_attention(
+                q, k, v, attn_mask, key_padding_mask, bsz, world_size
             )
-            row, col = attn_weights.size(1), attn_weights.size(2)
-            row //= world_size
-            col //= world_size
-            for i in range(world_size):
-                zero_mask[:, row * i : row * (i + 1), col * i : col * (i + 1)] = 0
-            zero_mask = zero_mask.type(torch.BoolTensor).cuda()
-            attn_weights = attn_weights.masked_fill(zero_mask, 0.0)
-        attn_weights = self.apply_sparse_mask(attn_weights, tgt_len, src_len, bsz)
+        elif (
+            not torch.jit.is_scripting()
+            and not self.onnx_trace
+            and not before_softmax
+            and self._use_compiled_attention_core(q)
+        ):
+            assert v is not None
+            if attn_mask is None:
+                attn_mask = q.new_zeros(tgt_len, src_len, dtype=torch.float)
+            if key_padding_mask is None:
+                key_padding_mask = torch.zeros(
+                    bsz, src_len, dtype=torch.bool, device=q.device
+                )
+            attn, attn_weights_float = _compiled_attention_core()(
+                q,
+                k,
+                v,
+                attn_mask.float(),
+                key_padding_mask.to(torch.bool),
+                self.num_heads,
+                self.scaling,
+                self.dropout_module.p,
+                self.training or self.dropout_module.apply_during_inference,
+                need_weights,
+            )
+        else:
+            # The 1/sqrt(head_dim) scaling is folded into the GEMM's alpha
+            # (SDPA above applies it itself). beta=0 ignores the input.
+            attn_weights = torch.baddbmm(
+                q.new_empty(()), q, k.mT, beta=0.0, alpha=self.scaling
+            )
+            if kv_cache_dtype is not None:
+                attn_weights = attn_weights.to(query.dtype)
+            attn_weights = self.apply_sparse_mask(attn_weights, tgt_len, src_len, bsz)
 
-        assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
+            if self.onnx_trace or before_softmax:
+                if attn_mask is not None:
+                    attn_mask = attn_mask.unsqueeze(0)
+                    if self.onnx_trace:
+                        attn_mask = attn_mask.repeat(attn_weights.size(0), 1, 1)
+                    attn_weights += attn_mask
 
-        if attn_mask is not None:
-            # Replace any non-finite values with finite equivalents, since otherwise
-            # we may get NaN when adding attn_mask or computing softmax.
-            attn_weights = torch.nan_to_num(attn_weights)
-
-            attn_mask = attn_mask.unsqueeze(0)
-            if self.onnx_trace:
-                attn_mask = attn_mask.repeat(attn_weights.size(0), 1, 1)
-            # Currently, ShardedTensor does not support addition assignment with broadcasting.
-            # Below is a walk-around to perform the op on the local tensor and recreate the ShardedTensor again.
-            if isinstance(attn_weights, ShardedTensor):
-                attn_mask = attn_mask.repeat(1, world_size, world_size)
-                attn_local = attn_weights.local_tensor()
-                attn_local += attn_mask
-                attn_weights = ShardedTensor._init_from_local_tensor(
-                    attn_local, attn_weights.sharding_spec(), attn_weights.size(), process_group=distributed_utils.get_model_parallel_group()
+                if key_padding_mask is not None:
+                    # don't attend to padding symbols
+                    attn_weights = attn_weights.view(
+                        bsz, self.num_heads, tgt_len, src_len
+                    )
+                    attn_weights = attn_weights.masked_fill(
+                        key_padding_mask.unsqueeze(1).unsqueeze(2).to(torch.bool),
+                        float("-inf"),
+                    )
+                    attn_weights = attn_weights.view(
+                        bsz * self.num_heads, tgt_len, src_len
+                    )
+
+                if before_softmax:
+                    return attn_weights, v
+
+                attn_weights_float = utils.softmax(
+                    attn_weights, dim=-1, onnx_trace=self.onnx_trace
                 )
-               
+                attn_weights = attn_weights_float.type_as(attn_weights)
+                attn_probs = self.dropout_module(attn_weights)
             else:
-                attn_weights += attn_mask
-
-        if key_padding_mask is not None:
-            # don't attend to padding symbols
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights.masked_fill(
-                key_padding_mask.unsqueeze(1).unsqueeze(2).to(torch.bool),
-                float("-inf"),
-            )
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-        if before_softmax:
-            return attn_weights, v
-        
-        # Mentioned in L389, we need to remove the interactions between non-related sequences.
-        if isinstance(attn_weights, ShardedTensor):
-            attn_weights = attn_weights.masked_fill(zero_mask, float("-inf"))
-        attn_weights_float = utils.softmax(
-            attn_weights, dim=-1, onnx_trace=self.onnx_trace
-        )
-        attn_weights = attn_weights_float.type_as(attn_weights)
-        attn_probs = self.dropout_module(attn_weights)
+                attn_weights_float, attn_probs = self._masked_softmax_dropout(
+                    attn_weights, attn_mask, key_padding_mask, need_weights
+                )
 
-        assert v is not None
-        attn = torch.bmm(attn_probs, v)
-        assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
+            assert v is not None
+            if kv_cache_dtype is not None:
+                attn_probs = attn_probs.to(kv_cache_dtype)
+            attn = torch.bmm(attn_probs, v)
+        if kv_cache_dtype is not None:
+            attn = attn.to(query.dtype)
         if self.onnx_trace and attn.size(1) == 1:
             # when ONNX tracing a single decoder step (sequence length == 1)
             # the transpose is a no-op copy before view, thus unnecessary
             attn = attn.contiguous().view(tgt_len, bsz, embed_dim)
         else:
-            attn = attn.transpose(0, 1).contiguous()
-            # As mentioned ealier, view op itself does not change the sharding dim.
-            # We need to manually change the sharding dim of attn from 1 to -1(2).
-            if isinstance(attn, ShardedTensor):
-                sharding_spec = attn.sharding_spec()
-                sharding_spec.dim = -1
-                st_size = (
-                    attn.size(0),
-                    attn.size(1) // world_size,
-                    attn.size(2) * world_size,
-                )
+            attn = (
+                attn.transpose(0, 1)
+                .contiguous()
+                .view(tgt_len, bsz, embed_dim // world_size)
+            )
+            if isinstance(self.out_proj.weight, ShardedTensor):
+                # the local heads are this rank's shard of the embedding dim
+                tp_sharding_spec.dim = -1
                 attn = ShardedTensor._init_from_local_tensor(
-                    attn.local_tensor(), sharding_spec, st_size, process_group=distributed_utils.get_model_parallel_group()
+                    attn,
+                    tp_sharding_spec,
+                    (tgt_len, bsz, embed_dim),
+                    process_group=distributed_utils.get_model_parallel_group(),
                 )
-            attn = attn.view(tgt_len, bsz, embed_dim)
 
         attn = self.out_proj(attn)
         attn_weights: Optional[Tensor] = None
         if need_weights:
+            assert attn_weights_float is not None
             attn_weights = attn_weights_float.view(
                 bsz, self.num_heads, tgt_len, src_len
             ).transpose(1, 0)
@@ -484,6 +689,242 @@ class MultiheadAttention(nn.Module):
 
         return attn, attn_weights
 
+    def _in_proj_packed(self, query: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """Projects *query* with the packed in_proj into q, k and v of shape
+        `(bsz * num_heads, seq_len, head_dim)`.
+
+        The projection is computed as a 3-way batched GEMM with the bias as
+        its input, whose `(3, seq_len, bsz * num_heads, head_dim)` output only
+        needs a view to be split into q, k and v; no separate bias add or
+        reshaping copy is required.
+        """
+        assert self.in_proj is not None
+        tgt_len, bsz, _ = query.size()
+        # (3 * embed_dim, in_dim) -> (3, in_dim, embed_dim)
+        weight = self.in_proj.weight.view(3, self.embed_dim, -1).mT
+        x = query.reshape(1, tgt_len * bsz, -1).expand(3, -1, -1)
+        bias = self.in_proj.bias
+        if bias is None:
+            qkv = torch.bmm(x, weight)
+        else:
+            qkv = torch.baddbmm(bias.view(3, 1, self.embed_dim), x, weight)
+        q, k, v = (
+            qkv.view(3, tgt_len, bsz * self.num_heads, self.head_dim)
+            .transpose(1, 2)
+            .unbind(0)
+        )
+        return q, k, v
+
+    def _masked_softmax_dropout(
+        self,
+        attn_weights: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+        need_weights: bool,
+    ) -> Tuple[Optional[Tensor], Tensor]:
+        p = self.dropout_module.p
+        training = self.training or self.dropout_module.apply_during_inference
+        # When the module itself is scripted, the plain function below is
+        # compiled into its graph and fused there.
+        if not torch.jit.is_scripting() and self._use_jit_fusion(attn_weights.device):
+            return _fused_masked_softmax_dropout()(
+                attn_weights,
+                attn_mask,
+                key_padding_mask,
+                self.num_heads,
+                p,
+                training,
+                need_weights,
+            )
+        return _masked_softmax_dropout(
+            attn_weights,
+            attn_mask,
+            key_padding_mask,
+            self.num_heads,
+            p,
+            training,
+            need_weights,
+        )
+
+    @torch.jit.unused
+    def _use_jit_fusion(self, device: torch.device) -> bool:
+        return _jit_fusion_supported(device)
+
+    @torch.jit.unused
+    def _has_default_sparse_mask(self) -> bool:
+        # Subclasses overriding apply_sparse_mask keep the eager path, which
+        # is the only one that calls it.
+        return type(self).apply_sparse_mask is MultiheadAttention.apply_sparse_mask
+
+    @torch.jit.unused
+    def _use_sdpa(self) -> bool:
+        return (
+            has_sdpa
+            and not isinstance(self.out_proj.weight, ShardedTensor)
+            and self._has_default_sparse_mask()
+        )
+
+    @torch.jit.unused
+    def _use_compiled_attention_core(self, q: Tensor) -> bool:
+        return (
+            self.compile_attention_core
+            and has_torch_compile
+            and q.is_cuda
+            and self._has_default_sparse_mask()
+        )
+
+    def _append_to_kv_buffer(
+        self,
+        saved_state: Dict[str, Optional[Tensor]],
+        name: str,
+        new: Tensor,
+        bsz: int,
+    ) -> Tensor:
+        """Appends *new*, of shape `(bsz * num_heads, seq_len, head_dim)`, to
+        the cached ``saved_state[name]`` and returns the full cache in the same
+        layout.
+
+        The cache is a prefix view of a preallocated ``name + "_buffer"`` of
+        shape `(bsz, num_heads, capacity, head_dim)`, so each step only writes
+        the new positions. The buffer is (re)allocated with room for twice the
+        current length, capped at *max_seq_len* if set, whenever it is too
+        small or no longer backs the cache (e.g. the cache was replaced after
+        a batch size change).
+        """
+        new = new.view(bsz, self.num_heads, -1, self.head_dim)
+        prev: Optional[Tensor] = None
+        if name in saved_state:
+            prev = saved_state[name]
+        prev_len = 0 if prev is None else prev.size(2)
+        seq_len = prev_len + new.size(2)
+
+        buffer_name = name + "_buffer"
+        buffer: Optional[Tensor] = None
+        if buffer_name in saved_state:
+            buffer = saved_state[buffer_name]
+        if (
+            buffer is None
+            or buffer.size(0) != bsz
+            or buffer.size(2) < seq_len
+            or buffer.dtype != new.dtype
+            or (prev is not None and prev.data_ptr() != buffer.data_ptr())
+        ):
+            capacity = 2 * seq_len
+            max_seq_len = self.max_seq_len
+            if max_seq_len is not None:
+                capacity = max(min(capacity, max_seq_len), seq_len)
+            buffer = new.new_empty((bsz, self.num_heads, capacity, self.head_dim))
+            if prev is not None:
+                buffer.narrow(2, 0, prev_len).copy_(prev)
+            saved_state[buffer_name] = buffer
+        assert buffer is not None
+        buffer.narrow(2, prev_len, new.size(2)).copy_(new)
+        return buffer.narrow(2, 0, seq_len).view(
+            bsz * self.num_heads, seq_len, self.head_dim
+        )
+
+    def _bias_kv_to_heads(self, bias_kv: Tensor, bsz: int) -> Tensor:
+        # (1, 1, embed_dim) -> (bsz * num_heads, 1, head_dim)
+        return (
+            bias_kv.view(1, self.num_heads, 1, self.head_dim)
+            .expand(bsz, -1, -1, -1)
+            .reshape(bsz * self.num_heads, 1, self.head_dim)
+        )
+
+    @torch.jit.unused
+    def _cat_in_proj_bias(self) -> Optional[Tensor]:
+        # F.multi_head_attention_forward expects a single in_proj_bias
+        if self.q_proj.bias is None:
+            return None
+        return torch.cat((self.q_proj.bias, self.k_proj.bias, self.v_proj.bias))
+
+    @torch.jit.unused
+    def _tensor_parallel_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+        bsz: int,
+        world_size: int,
+    ) -> Tensor:
+        """Attention over the SPMD-style tensor parallel local tensors.
+
+        *q*, *k* and *v* hold this rank's heads for the inputs gathered from
+        all *world_size* ranks, i.e. they are shaped
+        `(bsz * num_heads // world_size, world_size * seq_len, head_dim)`.
+        Scores between sequences coming from different ranks are meaningless,
+        so rather than computing the full `world_size * tgt_len` x
+        `world_size * src_len` matrix and masking out its off-diagonal blocks,
+        the world_size dimension is folded into the batch and only the diagonal
+        blocks are ever computed.
+        """
+        bsz_heads = q.size(0)
+        # (bsz_heads, world_size * seq_len, head_dim) ->
+        # (bsz_heads * world_size, seq_len, head_dim)
+        q = q.reshape(bsz_heads * world_size, -1, self.head_dim)
+        k = k.reshape(bsz_heads * world_size, -1, self.head_dim)
+        v = v.reshape(bsz_heads * world_size, -1, self.head_dim)
+        tgt_len, src_len = q.size(1), k.size(1)
+
+        attn_weights = torch.baddbmm(
+            q.new_empty(()), q, k.mT, beta=0.0, alpha=self.scaling
+        )
+        attn_weights = self.apply_sparse_mask(attn_weights, tgt_len, src_len, bsz)
+        # The batch is ordered (bsz, num_heads // world_size, world_size), so the
+        # (bsz, src_len) padding mask still broadcasts over num_heads entries.
+        _, attn_probs = self._masked_softmax_dropout(
+            attn_weights, attn_mask, key_padding_mask, need_weights=False
+        )
+        return torch.bmm(attn_probs, v).view(bsz_heads, -1, self.head_dim)
+
+    @torch.jit.unused
+    def _sdpa_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+        bsz: int,
+    ) -> Tensor:
+        """Attention through :func:`F.scaled_dot_product_attention`.
+
+        *q*, *k* and *v* are unscaled and of shape `(bsz * num_heads, seq_len,
+        head_dim)`. *attn_mask* and *key_padding_mask* are folded into a single
+        additive float mask so that SDPA can dispatch to the FlashAttention or
+        memory-efficient kernels.
+        """
+        tgt_len, src_len = q.size(1), k.size(1)
+        q = q.view(bsz, self.num_heads, tgt_len, self.head_dim)
+        k = k.view(bsz, self.num_heads, src_len, self.head_dim)
+        v = v.view(bsz, self.num_heads, src_len, self.head_dim)
+
+        combined_mask: Optional[Tensor] = None
+        if attn_mask is not None:
+            combined_mask = attn_mask.to(q.dtype).unsqueeze(0).unsqueeze(0)
+        if key_padding_mask is not None:
+            padding_mask = q.new_zeros(bsz, 1, 1, src_len).masked_fill_(
+                key_padding_mask.view(bsz, 1, 1, src_len).to(torch.bool),
+                float("-inf"),
+            )
+            if combined_mask is None:
+                combined_mask = padding_mask
+            else:
+                combined_mask = combined_mask + padding_mask
+
+        dropout_p = 0.0
+        if self.training or self.dropout_module.apply_during_inference:
+            dropout_p = self.dropout_module.p
+
+        attn = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=combined_mask, dropout_p=dropout_p
+        )
+        # The fused kernels may return a (bsz, tgt_len, num_heads, head_dim)
+        # layout, which cannot be viewed with the heads folded into the batch.
+        return attn.reshape(bsz * self.num_heads, tgt_len, self.head_dim)
+
     @staticmethod
     def _append_prev_key_padding_mask(
         key_padding_mask: Optional[Tensor],
@@ -497,7 +938,8 @@ class MultiheadAttention(nn.Module):
             new_key_padding_mask = prev_key_padding_mask
         elif prev_key_padding_mask is not None and key_padding_mask is not None:
             new_key_padding_mask = torch.cat(
-                [prev_key_padding_mask.float(), key_padding_mask.float()], dim=1
+                [prev_key_padding_mask.to(torch.bool), key_padding_mask.to(torch.bool)],
+                dim=1,
             )
         # During incremental decoding, as the padding token enters and
         # leaves the frame, there will be a time when prev or current
@@ -506,24 +948,26 @@ class MultiheadAttention(nn.Module):
             if src_len > prev_key_padding_mask.size(1):
                 filler = torch.zeros(
                     (batch_size, src_len - prev_key_padding_mask.size(1)),
+                    dtype=torch.bool,
                     device=prev_key_padding_mask.device,
                 )
                 new_key_padding_mask = torch.cat(
-                    [prev_key_padding_mask.float(), filler.float()], dim=1
+                    [prev_key_padding_mask.to(torch.bool), filler], dim=1
                 )
             else:
-                new_key_padding_mask = prev_key_padding_mask.float()
+                new_key_padding_mask = prev_key_padding_mask.to(torch.bool)
         elif key_padding_mask is not None:
             if src_len > key_padding_mask.size(1):
                 filler = torch.zeros(
                     (batch_size, src_len - key_padding_mask.size(1)),
+                    dtype=torch.bool,
                     device=key_padding_mask.device,
                 )
                 new_key_padding_mask = torch.cat(
-                    [filler.float(), key_padding_mask.float()], dim=1
+                    [filler, key_padding_mask.to(torch.bool)], dim=1
                 )
             else:
-                new_key_padding_mask = key_padding_mask.float()
+                new_key_padding_mask = key_padding_mask.to(torch.bool)
         else:
             new_key_padding_mask = prev_key_padding_mask
         return new_key_padding_mask
@@ -538,16 +982,44 @@ class MultiheadAttention(nn.Module):
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
             for k in input_buffer.keys():
+                if k.endswith("_buffer"):
+                    # reordered together with the cache views into them below
+                    continue
                 input_buffer_k = input_buffer[k]
                 if input_buffer_k is not None:
                     if self.encoder_decoder_attention and input_buffer_k.size(
                         0
                     ) == new_order.size(0):
                         break
-                    input_buffer[k] = input_buffer_k.index_select(0, new_order)
+                    reordered = input_buffer_k.index_select(0, new_order)
+                    buffer: Optional[Tensor] = None
+                    if k + "_buffer" in input_buffer:
+                        buffer = input_buffer[k + "_buffer"]
+                    if (
+                        buffer is not None
+                        and buffer.size(0) == reordered.size(0)
+                        and buffer.data_ptr() == input_buffer_k.data_ptr()
+                    ):
+                        # keep the cache backed by its preallocated buffer
+                        buffer.narrow(2, 0, reordered.size(2)).copy_(reordered)
+                        reordered = buffer.narrow(2, 0, reordered.size(2))
+                    input_buffer[k] = reordered
             incremental_state = self._set_input_buffer(incremental_state, input_buffer)
         return incremental_state
 
+    def make_generation_fast_(
+        self,
+        kv_cache_dtype: Optional[torch.dtype] = None,
+        max_seq_len: Optional[int] = None,
+        **unused,
+    ):
+        """Optionally stores the incremental decoding key/value cache in
+        *kv_cache_dtype* (e.g. ``torch.bfloat16`` for an fp32 model), halving
+        the bytes read per decoding step, and caps its preallocated capacity
+        at *max_seq_len* positions."""
+        self.kv_cache_dtype = kv_cache_dtype
+        self.max_seq_len = max_seq_len
+
     def _get_input_buffer(
         self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
     ) -> Dict[str, Optional[Tensor]]:
@@ -598,3 +1070,19 @@ class MultiheadAttention(nn.Module):
 
         for key, value in items_to_add.items():
             state_dict[key] = value
+
+        # Input projections may be stored either packed (in_proj) or split
+        # (q_proj, k_proj, v_proj); convert to the layout used by this module.
+        for param in ("weight", "bias"):
+            packed_key = prefix + "in_proj." + param
+            split_keys = [prefix + p + "_proj." + param for p in ("q", "k", "v")]
+            if self.combine_qkv_proj:
+                if all(key in state_dict for key in split_keys):
+                    state_dict[packed_key] = torch.cat(
+                        [state_dict.pop(key) for key in split_keys], dim=0
+                    )
+            elif packed_key in state_dict:
+                for key, value in zip(
+                    split_keys, state_dict.pop(packed_key).chunk(3, dim=0)
+                ):
+                    state_dict[key] = value
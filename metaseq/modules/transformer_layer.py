@@ -420,6 +420,10 @@ class TransformerDecoderLayer(nn.Module):
             initialize_params_on_gpu=getattr(
                 args, "tensor_parallel_init_model_on_gpu", False
             ),
+            # PTD tensor parallel shards q_proj/k_proj/v_proj separately
+            combine_qkv_proj=getattr(args, "combine_qkv_proj", False)
+            and not getattr(args, "tp_enabled", False),
+            compile_attention_core=getattr(args, "compile_attention", False),
         )
 
     def build_encoder_attention(self, embed_dim, args):
@@ -433,6 +437,7 @@ class TransformerDecoderLayer(nn.Module):
             initialize_params_on_gpu=getattr(
                 args, "tensor_parallel_init_model_on_gpu", False
             ),
+            compile_attention_core=getattr(args, "compile_attention", False),
         )
 
     def prepare_for_onnx_export_(self):